@@ -3,10 +3,71 @@
 """Reference: http://thew-project.org/papers/Badilini.ISHNE.Holter.Standard.pdf"""
 
 import os
+import mmap
 import numpy as np
+import binascii
 import datetime
-import sys
-from PyCRC.CRCCCITT import CRCCCITT
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+################################## Constants: ##################################
+
+# Lead types (Table 1 of the ISHNE Holter spec):
+lead_specs = {
+    -9: 'absent', 0: 'unknown', 1: 'generic',
+    2: 'X',    3: 'Y',    4: 'Z',
+    5: 'I',    6: 'II',   7: 'III',
+    8: 'aVR',  9: 'aVL', 10: 'aVF',
+    11: 'V1', 12: 'V2',  13: 'V3',
+    14: 'V4', 15: 'V5',  16: 'V6',
+    17: 'ES', 18: 'AS',  19: 'AI'
+}
+
+# Lead qualities (Table 2 of the ISHNE Holter spec):
+lead_qualities = {
+    -9: 'absent',
+    0: 'unknown',
+    1: 'good',
+    2: 'intermittent noise',
+    3: 'frequent noise',
+    4: 'intermittent disconnect',
+    5: 'frequent disconnect'
+}
+
+# Pacemaker codes:
+pm_codes = {
+    0: 'none',
+    1: 'unknown type',
+    2: 'single chamber unipolar',
+    3: 'dual chamber unipolar',
+    4: 'single chamber bipolar',
+    5: 'dual chamber bipolar',
+}
+
+# Layout of the fixed-size part of the file (pre-header included), in the order
+# the fields are stored.  ISHNE files are little-endian:
+_HEADER_STRUCT = struct.Struct('<8sH iiii h 40s40s20s hh 3h3h3h3h h 12h12h12h h 40s h 80s80s88s')
+
+# Single integers, as read by get_short_int() and get_long_int():
+_INT16_STRUCT = struct.Struct('<h')
+_INT32_STRUCT = struct.Struct('<i')
+
+# A date (day, month, year) or time (hour, minute, second) in the header:
+_DATETIME_STRUCT = struct.Struct('<3h')
+
+# One beat record in an annotation file: label, internal label, and number of
+# samples since the previous beat:
+_ANN_DTYPE = np.dtype([('ann', 'u1'), ('internal', 'u1'), ('toc', '<i2')])
+
+# Number of samples per lead to process at a time when converting data:
+_TILE_SAMPLES = 16384
+
+# Samples per lead that write_file converts and writes at a time:
+_WRITE_BLOCK_SAMPLES = 65536
+
+# Flags for opening files with os.open(); O_BINARY only exists (and matters) on
+# Windows:
+_O_RDONLY = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
 
 ################################## Functions: ##################################
 
@@ -19,15 +80,30 @@ def get_val(filename, ptr, datatype):
         val = val[0]
     return val
 
+def read_bytes(fd, ptr, size):
+    """Read up to 'size' bytes from position 'ptr' of an open file descriptor, with
+    a single positioned read where the OS supports it.
+    """
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, ptr)
+    os.lseek(fd, ptr, os.SEEK_SET)
+    return os.read(fd, size)
+
+def unpack_at(filename, ptr, fmt):
+    """Jump to position 'ptr' in file and decode the values described by 'fmt' (a
+    struct.Struct).  Return them as a tuple.
+    """
+    with open(filename, 'rb') as f:
+        f.seek(ptr, os.SEEK_SET)
+        return fmt.unpack(f.read(fmt.size))
+
 def get_short_int(filename, ptr):
     """Jump to position 'ptr' in file and read a 16-bit integer."""
-    val = get_val(filename, ptr, np.int16)
-    return int( val )
+    return unpack_at(filename, ptr, _INT16_STRUCT)[0]
 
 def get_long_int(filename, ptr):
     """Jump to position 'ptr' in file and read a 32-bit integer."""
-    val = get_val(filename, ptr, np.int32)
-    return int( val )
+    return unpack_at(filename, ptr, _INT32_STRUCT)[0]
 
 def get_datetime(filename, offset, time=False):
     """Read three consecutive 16-bit values from file and interpret them as (day,
@@ -38,7 +114,15 @@ def get_datetime(filename, offset, time=False):
     offset -- start address of first value in file
     time -- True if we're getting (h,m,s), False if we're getting (d,m,y)
     """
-    a,b,c = [get_short_int(filename, offset+2*i) for i in range(3)]
+    values = unpack_at(filename, offset, _DATETIME_STRUCT)
+    return make_datetime(values, time)
+
+def make_datetime(values, time=False):
+    """Interpret three values as (day, month, year) or (hour, minute, second), as
+    stored in the ISHNE header.  Return a date or time object, or None if the
+    values don't form a valid one.
+    """
+    a,b,c = values
     try:
         if time:
             output = datetime.time(a,b,c)
@@ -48,6 +132,26 @@ def get_datetime(filename, offset, time=False):
         output = None
     return output
 
+def as_bytes(text):
+    """Return a header text field as bytes.  Fields loaded from a file already are
+    bytes; ones set by the user may be str (encoded as UTF-8) or None.
+    """
+    if text is None:
+        return b''
+    if isinstance(text, str):
+        return text.encode('UTF-8')
+    return text
+
+def split_datetime(value, time=False):
+    """The reverse of make_datetime(): return the three values that represent a
+    date or time object in the ISHNE header, or zeros if it's None.
+    """
+    if not value:
+        return (0, 0, 0)  # TODO?: -9s
+    if time:
+        return (value.hour, value.minute, value.second)
+    return (value.day, value.month, value.year)
+
 def ckstr(checksum):
     """Return a value as e.g. 'FC8E', i.e. an uppercase hex string with no leading
     '0x' or trailing 'L'.
@@ -72,7 +176,9 @@ class Holter:
     def __str__(self):
         result = ''
         for key in vars(self):
-            if key == 'lead':
+            if key.startswith('_'):
+                continue  # internal bookkeeping, not part of the header
+            elif key == 'lead':
                 result += 'leads: ' + str([str(l) for l in self.lead]) + '\n'
             elif key == 'beat_anns':
                 result += 'beat_anns: %d beat annotations\n' % len(self.beat_anns)
@@ -84,67 +190,135 @@ class Holter:
 
     def load_header(self):
         filename = self.filename
-        assert os.path.getsize(filename) >= 522, "File is too small to be an ISHNE Holter."
-
-        self.magic_number = get_val(filename, 0, 'a8')
-        self.checksum = get_val(filename, 8, np.uint16)
-        #print( "Checksum in file: %s" % ckstr(self.checksum) )
-
-        # Fixed-size part of header:
-        self.var_block_size   =   get_long_int(filename,  10)
-        self.ecg_size         =   get_long_int(filename,  14)  # in number of samples
-        self.var_block_offset =   get_long_int(filename,  18)  # start of variable-length block
-        self.ecg_block_offset =   get_long_int(filename,  22)  # start of ECG samples
-        self.file_version     =  get_short_int(filename,  26)
-        self.first_name       =        get_val(filename,  28, 'a40').split(b'\x00')[0]
-        self.last_name        =        get_val(filename,  68, 'a40').split(b'\x00')[0]
-        self.id               =        get_val(filename, 108, 'a20').split(b'\x00')[0]
-        self.sex              =  get_short_int(filename, 128)  # 1=male, 2=female
-        self.race             =  get_short_int(filename, 130)  # 1=white, 2=black, 3=oriental
-        self.birth_date       =   get_datetime(filename, 132)
-        self.record_date      =   get_datetime(filename, 138)  # recording date
-        self.file_date        =   get_datetime(filename, 144)  # date of creation of output file
-        self.start_time       =   get_datetime(filename, 150, time=True)  # start time of Holter
-        self.nleads           =  get_short_int(filename, 156)
-        lead_spec             = [get_short_int(filename, 158+i*2) for i in range(12)]
-        lead_quality          = [get_short_int(filename, 182+i*2) for i in range(12)]
-        ampl_res              = [get_short_int(filename, 206+i*2) for i in range(12)]  # lead resolution in nV
-        self.pm               =  get_short_int(filename, 230)  # pacemaker
-        self.recorder_type    =        get_val(filename, 232, 'a40').split(b'\x00')[0]  # analog or digital
-        self.sr               =  get_short_int(filename, 272)  # sample rate in Hz
-        self.proprietary      =        get_val(filename, 274, 'a80').split(b'\x00')[0]
-        self.copyright        =        get_val(filename, 354, 'a80').split(b'\x00')[0]
-        self.reserved         =        get_val(filename, 434, 'a88').split(b'\x00')[0]
-        # TODO?: read all the above with one open()
-
-        # Variable-length part of header:
-        if self.var_block_size > 0:
-            self.var_block = get_val(filename, 522, 'a'+str(self.var_block_size)).split(b'\x00')[0]
-        else:
-            self.var_block = None
+        # Read the whole fixed-size header at once and decode it in one go.  We
+        # use a bare file descriptor since we only need a couple of reads:
+        fd = os.open(filename, _O_RDONLY)
+        try:
+            # fstat on the open descriptor rather than a separate stat by name:
+            # Snapshot of the size, taken along with the header (and updated by
+            # write_file); used by is_valid() and get_length():
+            self._filesize = os.fstat(fd).st_size
+            assert self._filesize >= 522, "File is too small to be an ISHNE Holter."
+            v = _HEADER_STRUCT.unpack(read_bytes(fd, 0, _HEADER_STRUCT.size))
+            self.magic_number     = v[0]
+            self.checksum         = v[1]
+            #print( "Checksum in file: %s" % ckstr(self.checksum) )
+
+            # Fixed-size part of header:
+            self.var_block_size   = v[2]
+            self.ecg_size         = v[3]  # in number of samples
+            self.var_block_offset = v[4]  # start of variable-length block
+            self.ecg_block_offset = v[5]  # start of ECG samples
+            self.file_version     = v[6]
+            self.first_name       = v[7].partition(b'\x00')[0]
+            self.last_name        = v[8].partition(b'\x00')[0]
+            self.id               = v[9].partition(b'\x00')[0]
+            self.sex              = v[10]  # 1=male, 2=female
+            self.race             = v[11]  # 1=white, 2=black, 3=oriental
+            self.birth_date       = make_datetime(v[12:15])
+            self.record_date      = make_datetime(v[15:18])  # recording date
+            self.file_date        = make_datetime(v[18:21])  # date of creation of output file
+            self.start_time       = make_datetime(v[21:24], time=True)  # start time of Holter
+            self.nleads           = v[24]
+            lead_spec             = v[25:37]
+            lead_quality          = v[37:49]
+            ampl_res              = v[49:61]  # lead resolution in nV
+            self.pm               = v[61]  # pacemaker
+            self.recorder_type    = v[62].partition(b'\x00')[0]  # analog or digital
+            self.sr               = v[63]  # sample rate in Hz
+            self.proprietary      = v[64].partition(b'\x00')[0]
+            self.copyright        = v[65].partition(b'\x00')[0]
+            self.reserved         = v[66].partition(b'\x00')[0]
+
+            # Variable-length part of header (directly follows the fixed part):
+            if self.var_block_size > 0:
+                self.var_block = read_bytes(fd, 522, self.var_block_size).partition(b'\x00')[0]
+            else:
+                self.var_block = None
+        finally:
+            os.close(fd)
 
         # Create array of Leads (where lead specs and data will be stored):
         self.lead = [None for _ in range(self.nleads)]
         for i in range(self.nleads):
             self.lead[i] = Lead(lead_spec[i], lead_quality[i], ampl_res[i])
 
-    def load_data(self, convert=True):
+    def load_data(self, convert=True, copy=True, dtype=np.float32):
         """This may take some time and memory, so we don't do it until we're asked.  The
         'lead' variable is a list of Lead objects where lead[i].data is the data
         for lead number i.
+
+        Keyword arguments:
+        convert -- whether sample values should be converted to mV
+        copy -- if False (and convert is False), lead data will be read-only views
+                into the file on disk instead of copies held in memory
+        dtype -- float type for converted data.  float32 keeps all 16 bits of
+                 the samples at half the memory of float64; pass float (i.e.
+                 float64) if you need it, or np.float16 for display only.
+                 Unconverted data is always int16 (scale it with lead.res).
         """
-        # Get the data:
-        with open(self.filename, 'rb') as f:
-            f.seek(self.ecg_block_offset, os.SEEK_SET)
-            data = np.fromfile(f, dtype=np.int16)
-        # Convert it to a 2D array, cropping the end if necessary:
-        nleads = self.nleads
-        data = np.reshape( data[:int(len(data)/nleads)*nleads],
-                                (nleads, int(len(data)/nleads)),
-                                order='F' )
-        # Save each row (lead), converting measurements to mV in the process:
-        for i in range(nleads):
-            self.lead[i].save_data( data[i], convert=convert )
+        # Get the data as a 2D array (one row per lead).  Nothing is read from
+        # disk until the samples are actually accessed:
+        data = self.map_samples().T
+        # Converting or copying reads the whole block, so have the kernel start
+        # fetching all of it now instead of page by page (POSIX only).  Views
+        # into the file (copy=False) are left to page in on demand:
+        if (convert or copy) and hasattr(os, 'posix_fadvise'):
+            fd = os.open(self.filename, _O_RDONLY)
+            try:
+                os.posix_fadvise(fd, self.ecg_block_offset, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        # Convert measurements to mV for all leads at once:
+        if convert:
+            scales = (np.array([lead.res for lead in self.lead]) / 1e6).astype(dtype)
+            # The ufunc casts the int16 samples as it goes, so there is no
+            # intermediate float copy to make and then walk again:
+            out = np.empty(data.shape, dtype=dtype)
+            # Go through the recording in tiles that stay in cache while the
+            # interleaved samples are scattered into the per-lead rows:
+            for start in range(0, data.shape[1], _TILE_SAMPLES):
+                tile = slice(start, start+_TILE_SAMPLES)
+                np.multiply(data[:, tile], scales[:, np.newaxis], out=out[:, tile])
+            data = out
+        elif copy:
+            # Always a real copy: with a single lead the transposed view is
+            # already contiguous, and ascontiguousarray() would just hand back
+            # the read-only view into the file:
+            data = data.copy()
+        # Save each row (lead):
+        for i in range(self.nleads):
+            self.lead[i].save_data( data[i], convert=False )
+
+    def map_samples(self):
+        """Memory-map the ECG block of the file on disk.  Return a read-only int16
+        array of shape (samples, leads), i.e. in the interleaved order of the
+        file, cropping the end if necessary.
+        """
+        fd = os.open(self.filename, _O_RDONLY)
+        try:
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)  # stays valid after close
+        finally:
+            os.close(fd)
+        # We (almost) always go through the samples front to back, so ask the
+        # kernel to read ahead aggressively (not available on all platforms):
+        if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        # A truncated file or bad header may put the ECG block past the end of
+        # the file; then there are simply no samples:
+        nsamples = max(len(mm) - self.ecg_block_offset, 0) // 2 // self.nleads
+        # The array keeps a reference to mm, which is unmapped when it's freed:
+        samples = np.frombuffer(mm, dtype='<i2', count=nsamples*self.nleads,
+                                offset=min(self.ecg_block_offset, len(mm)))
+        return samples.reshape(nsamples, self.nleads)
+
+    def lead_view(self, i):
+        """Return (samples, scale, sr) for lead number i without loading anything:
+        samples is a read-only int16 view into the file on disk (see
+        map_samples), and samples*scale gives the signal in mV.  Useful for
+        streaming one lead through some processing without load_data().
+        """
+        return self.map_samples()[:, i], self.lead[i].res/1e6, self.sr
 
     def load_ann(self, annfile=None):
         """Load beat annotations in accordance with
@@ -157,25 +331,27 @@ class Holter:
         annheader = Holter(annfile, annfile=True)  # note, var_block_offset may be wrong in .ann files
         filesize = os.path.getsize(annfile)
         headersize = 522 + annheader.var_block_size + 4
-        self.beat_anns = []
         with open(annfile, 'rb') as f:
             f.seek(headersize-4, os.SEEK_SET)
-            first_sample = np.fromfile(f, dtype=np.uint32, count=1)[0]
-            current_sample = first_sample
-            timeout = False  # was there a gap in the annotations?
-            for beat in range( int((filesize - headersize) / 4) ):
-                # note, the beat at first_sample isn't annotated.  so the first beat
-                # in beat_anns is actually the second beat of the recording.
-                ann      = chr(np.fromfile(f, dtype=np.uint8, count=1)[0])
-                internal = chr(np.fromfile(f, dtype=np.uint8, count=1)[0])
-                toc      =     np.fromfile(f, dtype=np.int16, count=1)[0]
-                current_sample += toc
-                if ann == '!':
-                    timeout = True  # there was a few minutes gap in the anns; don't
-                                    # know how to line them up to rest of recording
-                self.beat_anns.append( {'ann': ann, 'internal': internal, 'toc': toc} )
-                if not timeout:
-                    self.beat_anns[-1]['samp_num'] = current_sample
+            first_sample = np.fromfile(f, dtype='<u4', count=1)[0]
+            # All beat records in one read:
+            anns = np.fromfile(f, dtype=_ANN_DTYPE, count=(filesize - headersize) // 4)
+        # note, the beat at first_sample isn't annotated.  so the first beat
+        # in beat_anns is actually the second beat of the recording.
+        samp_nums = first_sample + np.cumsum(anns['toc'], dtype=np.int64)
+        # A '!' means there was a few minutes gap in the anns; we don't know
+        # how to line them up to rest of recording, so beats from the first
+        # one on get no sample number:
+        timeouts = np.flatnonzero(anns['ann'] == ord('!'))
+        ntimed = timeouts[0] if len(timeouts) else len(anns)
+        self.beat_anns = [
+            {'ann': ann, 'internal': internal, 'toc': toc}
+            for ann, internal, toc in zip(anns['ann'].tobytes().decode('latin-1'),
+                                          anns['internal'].tobytes().decode('latin-1'),
+                                          anns['toc'])
+        ]
+        for beat, samp_num in zip(self.beat_anns[:ntimed], samp_nums[:ntimed]):
+            beat['samp_num'] = samp_num
 
     def deidentify(self):
         """Remove all PII from the file header."""
@@ -199,18 +375,24 @@ class Holter:
         header_block -- a bytes object containing the ISHNE header (typically bytes 10-522 of the file)
         """
         if header_block == None:
-            with open(self.filename, 'rb') as f:
-                f.seek(10, os.SEEK_SET)
-                header_block = np.fromfile(f, dtype=np.uint8, count=self.ecg_block_offset-10)
-                header_block = header_block.tostring()  # to make it a bytes object
-        return np.uint16( CRCCCITT(version='FFFF').calculate(header_block) )
+            fd = os.open(self.filename, _O_RDONLY)
+            try:
+                header_block = read_bytes(fd, 10, self.ecg_block_offset-10)
+            finally:
+                os.close(fd)
+        # CRC-CCITT with initial value 0xFFFF (a.k.a. CRC-16/CCITT-FALSE).
+        # binascii implements it in C, so this works on any bytes-like object
+        # and returns a plain int:
+        return binascii.crc_hqx(header_block, 0xFFFF)
         # Another method to do the calculation:
         #   from crccheck.crc import Crc16CcittFalse
         #   Crc16CcittFalse.calc( header )
 
     def is_valid(self, verify_checksum=True):
         """Check for obvious problems with the file: wrong file signature, bad checksum,
-        or invalid values for file or header size.
+        or invalid values for file or header size.  Like the header fields, the
+        file size checked is the one seen when the file was loaded (or last
+        written); only the checksum is recomputed from self.filename.
         """
         # Check magic number:
         if self.is_annfile: expected_magic_number = b'ANN  1.0'
@@ -223,7 +405,7 @@ class Holter:
         # Check file size.  We have no way to predict this for annotations,
         # because it depends on heart rate and annotation quality:
         if not self.is_annfile:
-            filesize = os.path.getsize(self.filename)
+            filesize = self._filesize
             expected = 522 + self.var_block_size + 2*self.ecg_size
             if filesize!=expected:
                 # ecg_size may have been reported as samples per lead instead of
@@ -231,7 +413,8 @@ class Holter:
                 expected += 2*self.ecg_size*(self.nleads-1)
                 if filesize!=expected:
                     return False
-        # Verify CRC:
+        # Verify CRC.  This is the only check that has to go back to the file,
+        # so it comes last:
         if verify_checksum and (self.checksum != self.compute_checksum()):
                 return False
         # TODO?: check SR > 0
@@ -243,99 +426,50 @@ class Holter:
         """Return the duration of the Holter as a timedelta object.  If data has already
         been loaded, duration will be computed as the length of the first lead
         in memory.  Otherwise, it will be computed from the size of the original
-        file on disk.
+        file on disk, as recorded when it was loaded (the same size is_valid()
+        checks).
         """
         try:
             duration = datetime.timedelta(seconds = 1.0 * len(self.lead[0].data) / self.sr)
         except TypeError:  # self.lead[0] probably doesn't exist
-            try:
-                filesize = os.path.getsize(self.filename)
-                duration = datetime.timedelta(seconds =
-                    1.0*(filesize - 522 - self.var_block_size) / 2 / self.nleads / self.sr
-                )
-            except OSError:  # probably bad path to original file
-                duration = None
+            duration = datetime.timedelta(seconds =
+                1.0*(self._filesize - 522 - self.var_block_size) / 2 / self.nleads / self.sr
+            )
         return duration
 
-    # TODO?:
-    # pm_codes = {
-    #     0: 'none',
-    #     1: 'unknown type',
-    #     2: 'single chamber unipolar',
-    #     3: 'dual chamber unipolar',
-    #     4: 'single chamber bipolar',
-    #     5: 'dual chamber bipolar',
-    # }
-
     # TODO: dictionaries for gender and race?
 
     def get_header_bytes(self):
         """Create the ISHNE header from the various instance variables.  The
         variable-length block is included, but the 10 'pre-header' bytes are
         not.
-
-        This is the only function in the class that requires python3, for
-        to_bytes().
         """
-        header = bytearray()
-
-        header += (self.var_block_size       ).to_bytes(4, sys.byteorder)
-        header += (self.ecg_size             ).to_bytes(4, sys.byteorder)
-        header += (self.var_block_offset     ).to_bytes(4, sys.byteorder)
-        header += (self.ecg_block_offset     ).to_bytes(4, sys.byteorder)
-        header += (self.file_version         ).to_bytes(2, sys.byteorder, signed=True)
-        header += bytes(self.first_name,'UTF-8')     [:40].ljust(40, b'\x00')
-        header += bytes(self.last_name,'UTF-8')      [:40].ljust(40, b'\x00')
-        header += bytes(self.id,'UTF-8')             [:20].ljust(20, b'\x00')
-        header += (self.sex                  ).to_bytes(2, sys.byteorder)
-        header += (self.race                 ).to_bytes(2, sys.byteorder)
-        if self.birth_date:
-            header += (self.birth_date.day   ).to_bytes(2, sys.byteorder)
-            header += (self.birth_date.month ).to_bytes(2, sys.byteorder)
-            header += (self.birth_date.year  ).to_bytes(2, sys.byteorder)
-        else:
-            header += (0                     ).to_bytes(6, sys.byteorder)  # TODO?: -9s
-        if self.record_date:
-            header += (self.record_date.day  ).to_bytes(2, sys.byteorder)
-            header += (self.record_date.month).to_bytes(2, sys.byteorder)
-            header += (self.record_date.year ).to_bytes(2, sys.byteorder)
-        else:
-            header += (0                     ).to_bytes(6, sys.byteorder)  # TODO?: -9s
-        if self.file_date:
-            header += (self.file_date.day    ).to_bytes(2, sys.byteorder)
-            header += (self.file_date.month  ).to_bytes(2, sys.byteorder)
-            header += (self.file_date.year   ).to_bytes(2, sys.byteorder)
-        else:
-            header += (0                     ).to_bytes(6, sys.byteorder)  # TODO?: -9s
-        if self.start_time:
-            header += (self.start_time.hour  ).to_bytes(2, sys.byteorder)
-            header += (self.start_time.minute).to_bytes(2, sys.byteorder)
-            header += (self.start_time.second).to_bytes(2, sys.byteorder)
-        else:
-            header += (0                     ).to_bytes(6, sys.byteorder)  # TODO?: -9s
-        header += (self.nleads               ).to_bytes(2, sys.byteorder)
-        for i in range(self.nleads):
-            header += (self.lead[i].spec     ).to_bytes(2, sys.byteorder, signed=True)
-        for i in range(12-self.nleads):
-            header += (-9                    ).to_bytes(2, sys.byteorder, signed=True)
-        for i in range(self.nleads):
-            header += (self.lead[i].qual     ).to_bytes(2, sys.byteorder, signed=True)
-        for i in range(12-self.nleads):
-            header += (-9                    ).to_bytes(2, sys.byteorder, signed=True)
-        for i in range(self.nleads):
-            header += (self.lead[i].res      ).to_bytes(2, sys.byteorder, signed=True)
-        for i in range(12-self.nleads):
-            header += (-9                    ).to_bytes(2, sys.byteorder, signed=True)
-        header += (self.pm                   ).to_bytes(2, sys.byteorder, signed=True)
-        header += self.recorder_type       [:40].ljust(40, b'\x00')
-        header += (self.sr                   ).to_bytes(2, sys.byteorder)
-        header += bytes(self.proprietary,'UTF-8')    [:80].ljust(80, b'\x00')
-        header += bytes(self.copyright,'UTF-8')      [:80].ljust(80, b'\x00')
-        header += bytes(self.reserved,'UTF-8')       [:88].ljust(88, b'\x00')
+        header = bytearray(_HEADER_STRUCT.size + self.var_block_size)
+        # Lead fields are padded with -9s to make room for 12 leads:
+        leads = self.lead[:self.nleads]
+        padding = [-9] * (12-self.nleads)
+        _HEADER_STRUCT.pack_into(
+            header, 0,
+            b'', 0,  # pre-header, filled in by write_file()
+            self.var_block_size, self.ecg_size, self.var_block_offset, self.ecg_block_offset,
+            self.file_version,
+            as_bytes(self.first_name), as_bytes(self.last_name), as_bytes(self.id),
+            self.sex, self.race,
+            *split_datetime(self.birth_date),
+            *split_datetime(self.record_date),
+            *split_datetime(self.file_date),
+            *split_datetime(self.start_time, time=True),
+            self.nleads,
+            *[lead.spec for lead in leads], *padding,
+            *[lead.qual for lead in leads], *padding,
+            *[lead.res  for lead in leads], *padding,
+            self.pm, as_bytes(self.recorder_type), self.sr,
+            as_bytes(self.proprietary), as_bytes(self.copyright), as_bytes(self.reserved)
+        )
         if self.var_block_size > 0:
-            header += self.var_block
+            header[_HEADER_STRUCT.size:] = as_bytes(self.var_block)
 
-        return bytes( header )
+        return bytes( header[10:] )
 
     def autofill_header(self):
         """Automatically update several header variables for consistency.  For example,
@@ -344,10 +478,7 @@ class Holter:
         string.
         """
         self.magic_number = b'ISHNE1.0'
-        try:
-            self.var_block_size = len( self.var_block )
-        except TypeError:
-            self.var_block_size = 0
+        self.var_block_size = len( as_bytes(self.var_block) )
         try:
             self.ecg_size = len( self.lead[0].data )
             # it's not clear if we should report the total number of samples
@@ -384,30 +515,41 @@ class Holter:
 
         if os.path.exists(self.filename):
             assert overwrite, "File with that name already exists."
-            os.remove(self.filename)  # overwrite is enabled; rm the existing
-                                      # file before we start (note: may fail if
-                                      # it's a directory not a file)
+            # overwrite is enabled; rm the existing file before we start (note:
+            # may fail if it's a directory not a file).  Removing rather than
+            # truncating it keeps the old data valid for anything still mapping
+            # it, e.g. lead data from load_data(copy=False):
+            os.remove(self.filename)
 
         # Prepare known/computable values such as variable block offset:
         self.autofill_header()
 
-        # Write file:
-        with open(self.filename, 'ab') as f:
+        # Write file.  A 128 KiB buffer (same as cp) instead of the default
+        # 8 KiB; the data block itself bypasses it via tofile():
+        with open(self.filename, 'wb', buffering=128*1024) as f:
             header = self.get_header_bytes()
-            # Preheader:
-            f.write( b'ISHNE1.0' )
-            f.write( self.compute_checksum(header_block=header) )
-            # Header:
-            f.write( header )
-            # Data block:
-            data = []
-            for i in range(self.nleads):
-                data += [ self.lead[i].data_int16(convert=convert_data) ]
-            data = np.reshape( data, self.nleads*len(self.lead[0].data), 'F' )
-            f.write( data )
+            checksum = self.compute_checksum(header_block=header)
+            # Preheader and header, in a single write:
+            f.write( b'ISHNE1.0' + checksum.to_bytes(2, 'little') + header )
+            # Data block, converted and written a block of samples at a time so
+            # that memory use doesn't grow with the length of the recording.
+            # Filling one column per lead gives the interleaved order of the
+            # file directly.  The buffer is explicitly little-endian, as the
+            # file is, so tofile() writes the right bytes on any host:
+            nsamples = data_counts[0]
+            block = np.empty((min(nsamples, _WRITE_BLOCK_SAMPLES), self.nleads), dtype='<i2')
+            for start in range(0, nsamples, _WRITE_BLOCK_SAMPLES):
+                stop = min(start+_WRITE_BLOCK_SAMPLES, nsamples)
+                samples, n = slice(start, stop), stop-start
+                for i in range(self.nleads):
+                    self.lead[i].data_int16(convert=convert_data, samples=samples, out=block[:n, i])
+                block[:n].tofile(f)
+            self._filesize = f.tell()
         # TODO?: remove partial file if it fails
 
 class Lead:
+    __slots__ = ('spec', 'qual', 'res', 'data')
+
     def __init__(self, spec, qual, res):
         """Store a lead's parameters (name, quality, and amplitude resolution).  Data
         (samples) from the lead will be loaded separately.
@@ -425,54 +567,88 @@ class Lead:
     def __str__(self):
         return self.spec_str()
 
-    def save_data(self, data, convert=True):
+    def save_data(self, data, convert=True, dtype=np.float32):
         """Replace the data array for this lead with a new one, optionally converting
         from ISHNE format (int16 samples) to floats (units = mV).
 
         Keyword arguments:
         data -- 1d numpy array of samples for this lead
         convert -- whether sample values should be converted to mV
+        dtype -- float type for converted data, as in Holter.load_data()
         """
         if convert:
-            data = data.astype(float)
+            data = data.astype(dtype)
             data *= self.res/1e6
         self.data = data
 
-    def data_int16(self, convert=True):
-        """Returns data in the format for saving to disk.  Pointless to use if convert==False."""
-        data = self.data
+    def data_int16(self, convert=True, samples=slice(None), out=None):
+        """Returns data in the format for saving to disk.  Pointless to use if convert==False.
+
+        Keyword arguments:
+        convert -- whether data needs to be converted back to int16 from float (mV)
+        samples -- slice of the data to return, e.g. to convert it in blocks
+        out -- optional int16 array to store the result in (and return), e.g. a
+               column of a write buffer, instead of allocating a new one
+        """
+        data = self.data[samples]
         if convert:
-            data *= 1e6/self.res
-            data = data.astype(np.int16)
-        return data
+            # Scale, round and clip in a single temporary, leaving self.data
+            # untouched.  Clipping saturates out-of-range values instead of
+            # letting them wrap around in the cast:
+            data = np.multiply(data, 1e6/self.res)
+            np.rint(data, out=data)
+            np.clip(data, -32768, 32767, out=data)
+        if out is not None:
+            np.copyto(out, data, casting='unsafe')
+            return out
+        return data.astype('<i2', copy=False) if convert else data
         # TODO?: maybe do this the other way around, save data unaltered as
         # int16 and make converted available as e.g. self.data_mV().  That may
         # reduce possibility of rounding errors during conversions.
 
     def spec_str(self):
         """Return this lead's human-readable name (e.g. 'V1')."""
-        lead_specs = {
-            -9: 'absent', 0: 'unknown', 1: 'generic',
-            2: 'X',    3: 'Y',    4: 'Z',
-            5: 'I',    6: 'II',   7: 'III',
-            8: 'aVR',  9: 'aVL', 10: 'aVF',
-            11: 'V1', 12: 'V2',  13: 'V3',
-            14: 'V4', 15: 'V5',  16: 'V6',
-            17: 'ES', 18: 'AS',  19: 'AI'
-        }
         return lead_specs[self.spec]
 
     def qual_str(self):
         """Return a description of this lead's quality (e.g. 'intermittent noise')."""
-        lead_quals = {
-            -9: 'absent',
-            0: 'unknown',
-            1: 'good',
-            2: 'intermittent noise',
-            3: 'frequent noise',
-            4: 'intermittent disconnect',
-            5: 'frequent disconnect'
-        }
-        return lead_quals[self.qual]
+        return lead_qualities[self.qual]
+
+################################ Batch loading: ################################
+
+def scan_headers(paths, workers=8, check_valid=True):
+    """Load the headers of many ISHNE files at once, e.g. to index a directory of
+    recordings.  Returns a list of Holter objects in the same order as paths.
+    Only headers are loaded (call load_data() on the ones you need), so memory
+    use stays small however many files there are.
+
+    Files are read from a pool of threads, since most of the time is spent
+    waiting on the OS reads, which release the GIL.
+
+    Keyword arguments:
+    paths -- iterable of filenames
+    workers -- number of threads to use
+    check_valid -- passed to Holter(); warn about files that look corrupt
+    """
+    with ThreadPoolExecutor(workers) as ex:
+        return list(ex.map(lambda path: Holter(path, check_valid=check_valid), paths))
+
+def load_batch(paths, workers=8, check_valid=True, **kwargs):
+    """Like scan_headers(), but also load the data of each file.  Any other keyword
+    arguments (e.g. dtype) are passed to load_data().  The bulk of the work
+    (paging in the samples and converting them) happens in NumPy without the
+    GIL, so files are loaded concurrently.
+
+    Keyword arguments:
+    paths -- iterable of filenames
+    workers -- number of threads to use
+    check_valid -- passed to Holter(); warn about files that look corrupt
+    """
+    def load(path):
+        holter = Holter(path, check_valid=check_valid)
+        holter.load_data(**kwargs)
+        return holter
+    with ThreadPoolExecutor(workers) as ex:
+        return list(ex.map(load, paths))
 
 ################################################################################
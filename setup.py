@@ -8,6 +8,7 @@ setup( name='ishneholterlib',
        author_email='alex.page@rochester.edu',
        license='MIT',
        packages=['ishneholterlib'],
-       install_requires=['numpy', 'PyCRC'],
+       python_requires='>=3.5',
+       install_requires=['numpy'],
        keywords='ISHNE Holter ECG EKG',
        zip_safe=False )